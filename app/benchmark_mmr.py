@@ -0,0 +1,69 @@
+"""
+Benchmarks the MMR re-ranking stage of retrieval on synthetic embeddings.
+
+Usage:
+    python -m app.benchmark_mmr --dim 1536 --top-k 3
+
+For 50 to 500 over-fetched candidates, times the FAISS search at that many candidates against a
+plain top_k search, plus candidate vector reconstruction and mmr_select. The "added" column is
+everything retrieve_relevant_chunks spends beyond a plain top_k search (the query embedding call
+is the same either way and is not included).
+"""
+import argparse
+import time
+import numpy as np
+import faiss
+from app.retriever import mmr_select
+from app.config import MMR_LAMBDA
+
+CANDIDATE_COUNTS = [50, 100, 200, 300, 400, 500]
+
+
+def benchmark(dim: int, top_k: int, repeats: int, index_size: int):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((index_size, dim)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    query = rng.standard_normal((1, dim)).astype('float32')
+
+    print(f"dim={dim} top_k={top_k} lambda={MMR_LAMBDA} index_size={index_size} repeats={repeats}")
+    print(f"{'candidates':>10}  {'search top_k ms':>15}  {'search ms':>9}  {'reconstruct ms':>14}  {'mmr ms':>8}  {'added ms':>9}")
+    for num_candidates in CANDIDATE_COUNTS:
+        baseline_search_times, search_times, reconstruct_times, mmr_times = [], [], [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            index.search(query, top_k)
+            baseline_search_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            _, indices = index.search(query, num_candidates)
+            search_times.append(time.perf_counter() - start)
+            candidate_ids = indices[0].astype(np.int64)
+
+            start = time.perf_counter()
+            candidate_vectors = index.reconstruct_batch(candidate_ids)
+            middle = time.perf_counter()
+            mmr_select(query, candidate_vectors, top_k, MMR_LAMBDA)
+            end = time.perf_counter()
+            reconstruct_times.append(middle - start)
+            mmr_times.append(end - middle)
+
+        baseline_search_ms = np.median(baseline_search_times) * 1000
+        search_ms = np.median(search_times) * 1000
+        reconstruct_ms = np.median(reconstruct_times) * 1000
+        mmr_ms = np.median(mmr_times) * 1000
+        added_ms = search_ms - baseline_search_ms + reconstruct_ms + mmr_ms
+        print(f"{num_candidates:>10}  {baseline_search_ms:>15.3f}  {search_ms:>9.3f}  {reconstruct_ms:>14.3f}  {mmr_ms:>8.3f}  {added_ms:>9.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MMR re-ranking latency.")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension (1536 for text-embedding-3-small)")
+    parser.add_argument("--top-k", type=int, default=3, help="Number of chunks selected")
+    parser.add_argument("--repeats", type=int, default=50, help="Timed runs per candidate count (median is reported)")
+    parser.add_argument("--index-size", type=int, default=5000, help="Number of vectors in the synthetic index")
+    args = parser.parse_args()
+    benchmark(args.dim, args.top_k, args.repeats, args.index_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Fits the relevance distance threshold for an embedding model from a labelled query set.
+
+The query set is a JSON list such as:
+    [
+        {"query": "Why did Alice follow the White Rabbit?", "relevant": true},
+        {"query": "What is the capital of France?", "relevant": false}
+    ]
+
+Usage:
+    python -m app.calibrate_relevance queries.json
+
+The embedding model defaults to the one recorded in the published index's manifest.
+
+The query set must contain both relevant and out-of-scope queries. The fitted threshold is
+merged into RELEVANCE_THRESHOLDS_PATH, which takes precedence over the defaults in app/config.py.
+It is not saved if it would gate most of the relevant queries, unless --force is given.
+Run it against the currently published knowledge base. The OpenAI API key is read from
+.streamlit/secrets.toml in the working directory, or from the OPENAI_API_KEY environment variable.
+"""
+import argparse
+import json
+import os
+import sys
+import numpy as np
+from typing import Dict, List, Tuple
+from app.retriever import load_faiss_index_and_chunks, embed_queries, get_active_index_paths, get_index_embedding_model
+from app.config import DEFAULT_EMBEDDING_MODEL, RELEVANCE_DISTANCE_THRESHOLDS, RELEVANCE_THRESHOLDS_PATH
+
+
+def load_labelled_queries(path: str) -> List[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        labelled_queries = json.load(f)
+    for item in labelled_queries:
+        if "query" not in item or "relevant" not in item:
+            raise ValueError(f"Each labelled query needs 'query' and 'relevant' keys, got: {item}")
+    return labelled_queries
+
+def fit_distance_threshold(
+    distances: np.ndarray,
+    labels: np.ndarray,
+    relevant_weight: float = 2.0
+) -> Tuple[float, Dict[str, int]]:
+    """
+    Picks the threshold that minimises weighted misclassifications, where a query counts as
+    relevant when its nearest chunk distance is <= threshold. Wrongly gating a relevant query
+    costs relevant_weight, letting an out-of-scope query through costs 1 (the LLM can still
+    answer "I don't know"). Ties go to the largest threshold so only clear misses are gated.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    if not labels.any() or labels.all():
+        raise ValueError("Need at least one relevant and one out-of-scope labelled query to fit a threshold.")
+
+    # Candidates sit between consecutive observed distances, plus one on either side of the range
+    unique_distances = np.unique(distances)
+    candidates = np.concatenate((
+        [unique_distances[0] - 1e-6],
+        (unique_distances[:-1] + unique_distances[1:]) / 2,
+        [unique_distances[-1] + 1e-6]
+    ))
+
+    predicted_relevant = distances[None, :] <= candidates[:, None]
+    false_gated = (~predicted_relevant & labels[None, :]).sum(axis=1)
+    false_passed = (predicted_relevant & ~labels[None, :]).sum(axis=1)
+    cost = relevant_weight * false_gated + false_passed
+
+    best = np.flatnonzero(cost == cost.min())[-1]
+    stats = {
+        "relevant_gated": int(false_gated[best]),
+        "out_of_scope_passed": int(false_passed[best]),
+        "relevant": int(labels.sum()),
+        "total": int(distances.size),
+    }
+    return float(candidates[best]), stats
+
+def nearest_chunk_distances(queries: List[str], embedding_model_name: str) -> np.ndarray:
+    index, chunks = load_faiss_index_and_chunks()
+    if index is None or not chunks:
+        raise RuntimeError("No knowledge base found. Build one in the app before calibrating.")
+    # All labelled queries go out in a single embeddings request (batched only for very large sets)
+    query_embeddings = embed_queries(queries, embedding_model_name)
+    distances, _ = index.search(query_embeddings, 1)
+    return distances[:, 0]
+
+def save_threshold(embedding_model_name: str, threshold: float, path: str = RELEVANCE_THRESHOLDS_PATH):
+    thresholds = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            thresholds = json.load(f)
+    thresholds[embedding_model_name] = threshold
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(thresholds, f, indent=4)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the relevance distance threshold from labelled queries.")
+    parser.add_argument("queries", help="JSON file with a list of {\"query\": ..., \"relevant\": true/false} items")
+    parser.add_argument("--embedding-model", default=None, help="Embedding model the knowledge base was built with (default: read from its manifest)")
+    parser.add_argument("--relevant-weight", type=float, default=2.0, help="Cost of gating a relevant query relative to passing an out-of-scope one")
+    parser.add_argument("--dry-run", action="store_true", help="Print the fitted threshold without saving it")
+    parser.add_argument("--force", action="store_true", help="Save the threshold even if it gates most relevant queries")
+    args = parser.parse_args()
+    if args.embedding_model is None:
+        _, index_path, _ = get_active_index_paths()
+        args.embedding_model = get_index_embedding_model(index_path) or DEFAULT_EMBEDDING_MODEL
+
+    labelled_queries = load_labelled_queries(args.queries)
+    labels = np.array([bool(item["relevant"]) for item in labelled_queries])
+    if not labels.any() or labels.all():
+        parser.error("the query set needs at least one relevant and one out-of-scope query")
+
+    try:
+        distances = nearest_chunk_distances([item["query"] for item in labelled_queries], args.embedding_model)
+    except RuntimeError as e:
+        # Raised when the OpenAI client has no API key or no knowledge base has been built
+        print(f"Error: {e}", file=sys.stderr)
+        print("Set OPENAI_API_KEY or add it to .streamlit/secrets.toml, and build the knowledge base in the app first.", file=sys.stderr)
+        sys.exit(1)
+
+    for item, distance in zip(labelled_queries, distances):
+        print(f"{distance:8.4f}  {'relevant    ' if item['relevant'] else 'out-of-scope'}  {item['query']}")
+
+    threshold, stats = fit_distance_threshold(distances, labels, args.relevant_weight)
+    print(f"\nFitted threshold for {args.embedding_model}: {threshold:.4f} (default: {RELEVANCE_DISTANCE_THRESHOLDS.get(args.embedding_model)})")
+    print(f"Relevant queries gated: {stats['relevant_gated']}/{stats['relevant']}, out-of-scope queries passed: {stats['out_of_scope_passed']}, total: {stats['total']}")
+
+    if stats['relevant_gated'] * 2 > stats['relevant']:
+        print("Warning: this threshold gates most relevant queries, so they would get the canned \"I don't know\" reply. Check the labels and the embedding model.", file=sys.stderr)
+        if not args.force and not args.dry_run:
+            print("Not saving. Re-run with --force to save it anyway.", file=sys.stderr)
+            sys.exit(1)
+
+    if not args.dry_run:
+        save_threshold(args.embedding_model, threshold)
+        print(f"Saved to {RELEVANCE_THRESHOLDS_PATH}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import os
 import streamlit as st
-# OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
+# Prefer st.secrets, falling back to the environment so command line tools such as
+# app/calibrate_relevance.py work without a .streamlit/secrets.toml in the working directory.
+try:
+    OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
+except (FileNotFoundError, KeyError):
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # Default Model Configurations 
 DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
@@ -27,6 +31,28 @@ IMAGE_GENERATION_MODELS = {
     "DALL-E 2": "dall-e-2",
 }
 
+# Relevance gating: maximum FAISS distance (squared L2 on normalized embeddings, i.e. 2 - 2 * cosine)
+# for a chunk to count as relevant. If no retrieved chunk is this close, the query is treated as
+# out of scope and answered locally without any completion or image call. These defaults are
+# deliberately loose; run `python -m app.calibrate_relevance` to fit values for your stories.
+RELEVANCE_DISTANCE_THRESHOLDS = {
+    "text-embedding-ada-002": 0.55, # ada-002 cosines are compressed into roughly 0.7-1.0
+    "text-embedding-3-small": 1.6,
+    "text-embedding-3-large": 1.6,
+}
+
+# Retrieval diversification: over-fetch MMR_FETCH_K candidates from FAISS and re-rank them with
+# maximal marginal relevance so overlapping chunks and repeated scenes don't crowd out the context.
+# MMR_LAMBDA weighs relevance to the query (1.0) against novelty versus already picked chunks (0.0).
+# With 1000-character chunks overlapping by 200, each passage shows up in about two chunks, and
+# repeated scenes add more near-duplicates, so the top 3 need a much wider pool to differ. 50 gives
+# MMR room to reach several distinct passages without pulling in mostly off-topic ones (far
+# candidates are also dropped by the relevance threshold). This has not been tuned on a labelled
+# retrieval set. Measured cost with app/benchmark_mmr.py on a 5000-vector 1536-d index: about
+# 0.2-0.8 ms at 50 candidates on top of a plain top-3 search, which itself takes about 5 ms.
+MMR_FETCH_K = 50
+MMR_LAMBDA = 0.7
+
 # Default Output Tone
 DEFAULT_TONE = "Funny"
 TONE_OPTIONS = ["Funny", "Narrator", "Whimsical", "Sarcastic", "Formal"]
@@ -36,3 +62,11 @@ DATA_DIR = "data/stories"
 EMBEDDINGS_DIR = "embeddings"
 FAISS_INDEX_PATH = os.path.join(EMBEDDINGS_DIR, "story_embeddings.faiss")
 TEXT_CHUNKS_PATH = os.path.join(EMBEDDINGS_DIR, "story_chunks.json") 
+INDEX_MANIFEST_FILENAME = "manifest.json" # Written next to each FAISS index, records the embedding model it was built with
+RELEVANCE_THRESHOLDS_PATH = os.path.join(EMBEDDINGS_DIR, "relevance_thresholds.json") # Written by app/calibrate_relevance.py
+
+# Versioned knowledge base builds. Each rebuild is written to its own directory under
+# INDEX_VERSIONS_DIR and published by atomically rewriting the CURRENT pointer file.
+INDEX_VERSIONS_DIR = os.path.join(EMBEDDINGS_DIR, "versions")
+CURRENT_INDEX_POINTER_PATH = os.path.join(EMBEDDINGS_DIR, "CURRENT")
+INDEX_VERSIONS_TO_KEEP = 3 # Older versions may still be read by sessions that have not refreshed yet
@@ -1,7 +1,7 @@
 import streamlit as st
 import faiss # Import faiss here
-from app.retriever import retrieve_relevant_chunks, load_faiss_index_and_chunks # Import load_faiss_index_and_chunks
-from app.responder import generate_response
+from app.retriever import retrieve_relevant_chunks, load_faiss_index_and_chunks, get_relevance_threshold, get_index_embedding_model
+from app.responder import generate_response, generate_out_of_scope_response
 from app.image_gen import generate_image_prompt, generate_image
 from app.config import DEFAULT_EMBEDDING_MODEL, DEFAULT_TEXT_GENERATION_MODEL, DEFAULT_IMAGE_GENERATION_MODEL, FAISS_INDEX_PATH, TEXT_CHUNKS_PATH # Import paths
 
@@ -37,16 +37,41 @@ def process_query(
             "image_url": None
         }
 
-    # 1. Retrieve relevant chunks
+    # Queries must be embedded with the model the index was built with, otherwise distances are
+    # meaningless (ada-002 and 3-small share a dimension, so a mismatch wouldn't even raise)
+    index_embedding_model = get_index_embedding_model(faiss_index_path)
+    if index_embedding_model and index_embedding_model != embedding_model_name:
+        print(f"Knowledge base was built with {index_embedding_model}, using it instead of {embedding_model_name} for this query.")
+        embedding_model_name = index_embedding_model
+
+    # 1. Retrieve relevant chunks, dropping any that are too far from the query to be useful
+    relevance_threshold = get_relevance_threshold(embedding_model_name)
     with st.spinner("Searching through my storybooks..."):
-        relevant_chunks = retrieve_relevant_chunks(
+        scored_chunks = retrieve_relevant_chunks(
             query,
             current_faiss_index, # Use the freshly loaded index
             current_all_chunks,  # Use the chunks from session state
-            embedding_model_name
+            embedding_model_name,
+            max_distance=relevance_threshold
         )
-        if not relevant_chunks:
-            print("No relevant chunks found for the query, LLM will generate 'I don't know' response.")
+
+    if scored_chunks is None:
+        # Embedding or search failed, e.g. an API error or an index built with a different embedding model
+        st.error("Error searching the story index. Check that the selected embedding model matches the one the knowledge base was built with, or try rebuilding it.")
+        print("Retrieval failed for the current query.")
+        return {
+            "story_response": "Oops! My memory seems to have a glitch. I couldn't search my storybooks just now. Please try again, or rebuild the knowledge base with the selected embedding model!",
+            "image_url": None
+        }
+    relevant_chunks = [chunk for chunk, _ in scored_chunks]
+
+    # Clearly out-of-scope queries get a local "I don't know" reply with no completion or image call
+    if not relevant_chunks:
+        print(f"No chunks within relevance threshold {relevance_threshold}. Skipping LLM and image generation.")
+        return {
+            "story_response": generate_out_of_scope_response(selected_tone),
+            "image_url": None
+        }
 
     # 2. Generate story response and get relevance flag
     with st.spinner("Crafting a response with a touch of magic..."):
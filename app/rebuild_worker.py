@@ -0,0 +1,236 @@
+import os
+import queue
+import shutil
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import streamlit as st
+from app.retriever import create_and_store_embeddings, get_index_version_paths, get_active_index_version, publish_index_version
+from app.config import INDEX_VERSIONS_DIR, INDEX_VERSIONS_TO_KEEP
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+STAGING_PREFIX = ".staging-"
+BUILD_LOCK_PATH = os.path.join(INDEX_VERSIONS_DIR, ".build.lock")
+MAX_FINISHED_JOBS = 20 # Finished jobs kept so sessions can still show how their last rebuild ended
+
+_version_lock = threading.Lock()
+_last_version_timestamp = ""
+_version_sequence = 0
+
+def _next_version_name() -> str:
+    """
+    Returns a version name that sorts lexically in submission order, which retention relies on.
+    Names are a UTC timestamp with microseconds followed by a per-process sequence number. The
+    timestamp never moves backwards within a process, so clock adjustments can't reorder builds.
+    """
+    global _last_version_timestamp, _version_sequence
+    with _version_lock:
+        timestamp = max(datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ'), _last_version_timestamp)
+        _last_version_timestamp = timestamp
+        _version_sequence += 1
+        return f"{timestamp}-{_version_sequence:06d}"
+
+
+class _BuildLock:
+    """
+    Exclusive OS-level lock on BUILD_LOCK_PATH, held while a job writes and publishes a version.
+    It guards against any other manager instance or process building at the same time, and the
+    OS releases it automatically if the holder dies.
+    """
+
+    def __enter__(self):
+        os.makedirs(INDEX_VERSIONS_DIR, exist_ok=True)
+        self._file = open(BUILD_LOCK_PATH, 'a+')
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError: # LK_LOCK gives up after ~10 seconds, keep waiting
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+
+
+class RebuildJob:
+    """A single knowledge base rebuild request and its progress."""
+
+    def __init__(self, embedding_model_name: str, uploaded_files=None):
+        self.id = uuid.uuid4().hex[:8]
+        self.version = _next_version_name()
+        self.embedding_model_name = embedding_model_name
+        self.uploaded_files = list(uploaded_files or [])
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = "Waiting for the rebuild worker..."
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _update_progress(self, fraction: float, message: str):
+        self.progress = max(0.0, min(1.0, fraction))
+        self.message = message
+
+
+class RebuildManager:
+    """
+    Runs knowledge base rebuilds one at a time on a background thread.
+
+    Each job writes into a private staging directory, which is renamed to its final
+    version directory and then published by atomically swapping the CURRENT pointer.
+    Queries keep reading the previously published index until the swap happens.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[RebuildJob]" = queue.Queue()
+        self._jobs: Dict[str, RebuildJob] = {}
+        self._jobs_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="kb-rebuild-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, embedding_model_name: str, uploaded_files=None) -> RebuildJob:
+        job = RebuildJob(embedding_model_name, uploaded_files)
+        with self._jobs_lock:
+            self._prune_finished_jobs()
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        print(f"Queued knowledge base rebuild job {job.id} (version {job.version}).")
+        return job
+
+    def get_job(self, job_id: str) -> Optional[RebuildJob]:
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[RebuildJob]:
+        with self._jobs_lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get_job(job_id)
+        if job is None or job.is_finished:
+            return False
+        job.cancel()
+        # A running job stops after its current embedding batch returns
+        job.message = "Cancelling..."
+        return True
+
+    def _prune_finished_jobs(self):
+        """Drops the oldest finished jobs beyond MAX_FINISHED_JOBS. Caller holds _jobs_lock."""
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job.cancel_event.is_set():
+                    job.status = CANCELLED
+                    job.message = "Rebuild cancelled before it started."
+                    continue
+                job.status = RUNNING
+                job.message = "Waiting for any other rebuild to finish..."
+                # Only one build may write and publish at a time, even across manager instances
+                with _BuildLock():
+                    self._build(job)
+            except Exception as e:
+                print(f"Unexpected error in rebuild job {job.id}: {e}")
+                job.status = FAILED
+                job.message = f"Rebuild failed: {e}"
+            finally:
+                # Uploaded file contents are no longer needed once the job is done
+                job.uploaded_files = []
+                self._queue.task_done()
+
+    def _build(self, job: RebuildJob):
+        if job.cancel_event.is_set():
+            job.status = CANCELLED
+            job.message = "Rebuild cancelled before it started."
+            return
+        job.message = "Starting rebuild..."
+        staging_dir = os.path.join(INDEX_VERSIONS_DIR, f"{STAGING_PREFIX}{job.version}")
+        final_dir = os.path.join(INDEX_VERSIONS_DIR, job.version)
+        index_path, chunks_path = get_index_version_paths(f"{STAGING_PREFIX}{job.version}")
+        os.makedirs(staging_dir, exist_ok=True)
+
+        try:
+            index, chunks = create_and_store_embeddings(
+                job.embedding_model_name,
+                uploaded_files=job.uploaded_files,
+                index_path=index_path,
+                chunks_path=chunks_path,
+                progress_callback=job._update_progress,
+                cancel_event=job.cancel_event
+            )
+            if job.cancel_event.is_set():
+                job.status = CANCELLED
+                job.message = "Rebuild cancelled. Still serving the previous knowledge base."
+                return
+            if index is None or not chunks:
+                job.status = FAILED
+                if not job.message.startswith("Error"):
+                    job.message = "Failed to build Knowledge Base. Check console for errors. Ensure PDFs are valid."
+                return
+
+            # The version directory only appears once it is complete, then CURRENT is swapped
+            os.replace(staging_dir, final_dir)
+            publish_index_version(job.version)
+            job.status = SUCCEEDED
+            job.progress = 1.0
+            job.message = f"Knowledge Base version {job.version} is live with {len(chunks)} chunks."
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            self._remove_old_versions()
+
+    def _remove_old_versions(self):
+        """Deletes all but the newest published versions, never touching the active one."""
+        if not os.path.isdir(INDEX_VERSIONS_DIR):
+            return
+        active_version = get_active_index_version()
+        versions = sorted(
+            name for name in os.listdir(INDEX_VERSIONS_DIR)
+            if not name.startswith(STAGING_PREFIX) and os.path.isdir(os.path.join(INDEX_VERSIONS_DIR, name))
+        )
+        for version in versions[:-INDEX_VERSIONS_TO_KEEP]:
+            if version == active_version:
+                continue
+            shutil.rmtree(os.path.join(INDEX_VERSIONS_DIR, version), ignore_errors=True)
+            print(f"Removed old knowledge base version '{version}'.")
+
+
+@st.cache_resource
+def get_rebuild_manager() -> RebuildManager:
+    """
+    Returns the process-wide rebuild manager shared by every Streamlit session.
+    Cached as a Streamlit resource so it survives module reloads on rerun.
+    """
+    return RebuildManager()
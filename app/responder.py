@@ -2,6 +2,20 @@ from typing import List, Tuple
 from app.utils import get_llm_model, num_tokens_from_string
 from openai import APIError
 
+# Canned "I don't know..." replies used when retrieval finds nothing close enough to the query,
+# so clearly out-of-scope questions never reach the LLM.
+OUT_OF_SCOPE_RESPONSES = {
+    "Funny": "I don't know! I flipped through every page of my storybooks, shook them upside down, and all that fell out was a very confused bookmark. Try asking me about Alice, Gulliver, or the Arabian Nights!",
+    "Narrator": "I don't know. And so the storyteller searched the great library from end to end, yet no tale held the answer to this question. Perhaps another question about Alice, Gulliver, or the Arabian Nights will fare better.",
+    "Whimsical": "I don't know... not even the Cheshire Cat could find that one, and he was grinning at every shelf! Ask me about the tales in my storybooks instead.",
+    "Sarcastic": "I don't know. Shocking, I realise, but my storybooks are oddly silent on anything that isn't in them. Try something about Alice, Gulliver, or the Arabian Nights.",
+    "Formal": "I don't know. I'm afraid the requested information cannot be found in my storybooks. Please ask about Alice in Wonderland, Gulliver's Travels, or The Arabian Nights.",
+}
+
+def generate_out_of_scope_response(tone: str) -> str:
+    """Returns a local "I don't know..." message in the given tone without calling the LLM."""
+    return OUT_OF_SCOPE_RESPONSES.get(tone, OUT_OF_SCOPE_RESPONSES["Funny"])
+
 def generate_response(
     query: str,
     relevant_chunks: List[str],
@@ -1,20 +1,48 @@
 import os
+import json
+import threading
 import numpy as np
 import faiss
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 from app.utils import load_pdfs, load_uploaded_pdfs, chunk_text, get_embedding_model, save_chunks, load_chunks, num_tokens_from_string
-from app.config import DATA_DIR, EMBEDDINGS_DIR, FAISS_INDEX_PATH, TEXT_CHUNKS_PATH
+from app.config import (
+    DATA_DIR,
+    EMBEDDINGS_DIR,
+    FAISS_INDEX_PATH,
+    TEXT_CHUNKS_PATH,
+    INDEX_VERSIONS_DIR,
+    CURRENT_INDEX_POINTER_PATH,
+    RELEVANCE_DISTANCE_THRESHOLDS,
+    RELEVANCE_THRESHOLDS_PATH,
+    MMR_FETCH_K,
+    MMR_LAMBDA,
+    INDEX_MANIFEST_FILENAME
+)
 import streamlit as st 
 
 def create_and_store_embeddings(
     embedding_model_name: str,
     uploaded_files: List[st.runtime.uploaded_file_manager.UploadedFile] = None, 
     chunk_size: int = 1000,
-    chunk_overlap: int = 200
+    chunk_overlap: int = 200,
+    index_path: str = FAISS_INDEX_PATH,
+    chunks_path: str = TEXT_CHUNKS_PATH,
+    progress_callback: Optional[Callable[[float, str], None]] = None,
+    cancel_event: Optional[threading.Event] = None
 ) -> Tuple[faiss.Index, List[str]]:
     
     print(f"Starting embedding creation with model: {embedding_model_name}")
 
+    def report(fraction: float, message: str):
+        print(message)
+        if progress_callback:
+            progress_callback(fraction, message)
+
+    def cancelled() -> bool:
+        return cancel_event is not None and cancel_event.is_set()
+
+    report(0.0, "Loading stories...")
+
     stories = []
     if uploaded_files:
         stories = load_uploaded_pdfs(uploaded_files)
@@ -37,7 +65,7 @@ def create_and_store_embeddings(
         print("No chunks generated from stories.")
         return None, []
 
-    print(f"Generated {len(all_chunks)} chunks.")
+    report(0.05, f"Generated {len(all_chunks)} chunks.")
 
     # Get the embedding client
     embedding_client = get_embedding_model(embedding_model_name)
@@ -45,10 +73,16 @@ def create_and_store_embeddings(
     embedding_dimension = 0
 
     BATCH_SIZE = 500 
+    num_batches = (len(all_chunks) + BATCH_SIZE - 1) // BATCH_SIZE
 
     for i in range(0, len(all_chunks), BATCH_SIZE):
+        if cancelled():
+            print("Embedding creation cancelled.")
+            return None, []
         batch = all_chunks[i:i + BATCH_SIZE]
-        print(f"Processing batch {i // BATCH_SIZE + 1}/{(len(all_chunks) + BATCH_SIZE - 1) // BATCH_SIZE} with {len(batch)} chunks...")
+        batch_number = i // BATCH_SIZE + 1
+        # Embedding calls dominate build time, so they account for most of the progress bar
+        report(0.05 + 0.85 * (batch_number - 1) / num_batches, f"Processing batch {batch_number}/{num_batches} with {len(batch)} chunks...")
         try:
             response = embedding_client.create(
                 input=batch,
@@ -61,7 +95,11 @@ def create_and_store_embeddings(
 
         except Exception as e:
             print(f"Error generating embeddings for batch starting at index {i}: {e}")
-            st.error(f"Error generating embeddings for a batch. Please check your OpenAI API usage and limits. Error: {e}")
+            error_message = f"Error generating embeddings for a batch. Please check your OpenAI API usage and limits. Error: {e}"
+            if progress_callback:
+                progress_callback(0.05 + 0.85 * (batch_number - 1) / num_batches, error_message)
+            else:
+                st.error(error_message)
             return None, [] # Stop processing if a batch fails
 
     print(f"Generated {len(embeddings)} embeddings in total with dimension {embedding_dimension}.")
@@ -70,28 +108,107 @@ def create_and_store_embeddings(
         print("Failed to generate any embeddings.")
         return None, []
 
+    if cancelled():
+        print("Embedding creation cancelled.")
+        return None, []
+
     # Convert embeddings to numpy array
     embeddings_np = np.array(embeddings).astype('float32')
 
     # Create FAISS index
     index = faiss.IndexFlatL2(embedding_dimension) # L2 distance for similarity
     index.add(embeddings_np)
-    print(f"FAISS index created with {index.ntotal} vectors.")
+    report(0.9, f"FAISS index created with {index.ntotal} vectors.")
 
     # Save FAISS index and chunks
-    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    save_chunks(all_chunks, TEXT_CHUNKS_PATH)
-    print(f"FAISS index saved to {FAISS_INDEX_PATH}")
-    print(f"Text chunks saved to {TEXT_CHUNKS_PATH}")
+    os.makedirs(os.path.dirname(index_path) or EMBEDDINGS_DIR, exist_ok=True)
+    faiss.write_index(index, index_path)
+    save_chunks(all_chunks, chunks_path)
+    save_index_manifest(index_path, embedding_model_name, len(all_chunks), embedding_dimension)
+    print(f"FAISS index saved to {index_path}")
+    print(f"Text chunks saved to {chunks_path}")
+    report(1.0, "Knowledge base files written.")
 
     return index, all_chunks
 
+def get_index_manifest_path(index_path: str) -> str:
+    """Returns the path of the manifest stored in the same directory as a FAISS index."""
+    return os.path.join(os.path.dirname(index_path), INDEX_MANIFEST_FILENAME)
+
+def save_index_manifest(index_path: str, embedding_model_name: str, num_chunks: int, dimension: int):
+    """Records how the index at index_path was built, so queries use the matching embedding model."""
+    manifest = {
+        "embedding_model": embedding_model_name,
+        "num_chunks": num_chunks,
+        "dimension": dimension,
+    }
+    with open(get_index_manifest_path(index_path), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+
+def get_index_embedding_model(index_path: str) -> Optional[str]:
+    """Returns the embedding model the index was built with, or None for indexes without a manifest."""
+    manifest_path = get_index_manifest_path(index_path)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("embedding_model")
+    except Exception as e:
+        print(f"Error loading index manifest {manifest_path}: {e}")
+        return None
+
+def get_index_version_paths(version: str) -> Tuple[str, str]:
+    """Returns the FAISS index and chunks paths inside a versioned build directory."""
+    version_dir = os.path.join(INDEX_VERSIONS_DIR, version)
+    return (
+        os.path.join(version_dir, os.path.basename(FAISS_INDEX_PATH)),
+        os.path.join(version_dir, os.path.basename(TEXT_CHUNKS_PATH))
+    )
+
+def get_active_index_version() -> Optional[str]:
+    """Returns the version named by the CURRENT pointer, or None if nothing is published."""
+    try:
+        with open(CURRENT_INDEX_POINTER_PATH, 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    if not version:
+        return None
+    index_path, chunks_path = get_index_version_paths(version)
+    if os.path.exists(index_path) and os.path.exists(chunks_path):
+        return version
+    print(f"CURRENT points to missing knowledge base version '{version}'.")
+    return None
+
+def get_active_index_paths() -> Tuple[Optional[str], str, str]:
+    """
+    Returns (version, index_path, chunks_path) for the knowledge base that should be served.
+    Falls back to the legacy unversioned files when no version has been published yet.
+    """
+    version = get_active_index_version()
+    if version:
+        index_path, chunks_path = get_index_version_paths(version)
+        return version, index_path, chunks_path
+    return None, FAISS_INDEX_PATH, TEXT_CHUNKS_PATH
+
+def publish_index_version(version: str):
+    """Atomically points CURRENT at a fully written version directory."""
+    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+    tmp_path = f"{CURRENT_INDEX_POINTER_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    # os.replace is atomic on POSIX and Windows, so readers see either the old or the new version
+    os.replace(tmp_path, CURRENT_INDEX_POINTER_PATH)
+    print(f"Published knowledge base version '{version}'.")
+
 def load_faiss_index_and_chunks() -> Tuple[faiss.Index, List[str]]:
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(TEXT_CHUNKS_PATH):
+    _, index_path, chunks_path = get_active_index_paths()
+    if os.path.exists(index_path) and os.path.exists(chunks_path):
         try:
-            index = faiss.read_index(FAISS_INDEX_PATH)
-            chunks = load_chunks(TEXT_CHUNKS_PATH)
+            index = faiss.read_index(index_path)
+            chunks = load_chunks(chunks_path)
             print(f"Loaded FAISS index with {index.ntotal} vectors and {len(chunks)} chunks.")
             return index, chunks
         except Exception as e:
@@ -99,33 +216,129 @@ def load_faiss_index_and_chunks() -> Tuple[faiss.Index, List[str]]:
             return None, []
     return None, []
 
+def embed_queries(queries: List[str], embedding_model_name: str, batch_size: int = 500) -> np.ndarray:
+    """Returns the query embeddings as an (n, dim) float32 array, using one API call per batch_size queries."""
+    embedding_client = get_embedding_model(embedding_model_name)
+    embeddings = []
+    for i in range(0, len(queries), batch_size):
+        response = embedding_client.create(
+            input=queries[i:i + batch_size],
+            model=embedding_model_name
+        )
+        # Sort by index so rows line up with the input order
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return np.array(embeddings).astype('float32')
+
+def embed_query(query: str, embedding_model_name: str) -> np.ndarray:
+    """Returns the query embedding as a (1, dim) float32 array ready for FAISS search."""
+    return embed_queries([query], embedding_model_name)
+
+def get_relevance_threshold(embedding_model_name: str) -> Optional[float]:
+    """
+    Returns the maximum FAISS (squared L2) distance at which a chunk still counts as relevant.
+    Calibrated values in RELEVANCE_THRESHOLDS_PATH take precedence over the defaults in config.
+    None means no threshold is known for the model and gating is disabled.
+    """
+    if os.path.exists(RELEVANCE_THRESHOLDS_PATH):
+        try:
+            with open(RELEVANCE_THRESHOLDS_PATH, 'r', encoding='utf-8') as f:
+                calibrated = json.load(f)
+            if embedding_model_name in calibrated:
+                return float(calibrated[embedding_model_name])
+        except Exception as e:
+            print(f"Error loading calibrated relevance thresholds: {e}")
+    return RELEVANCE_DISTANCE_THRESHOLDS.get(embedding_model_name)
+
+def mmr_select(
+    query_vector: np.ndarray,
+    candidate_vectors: np.ndarray,
+    top_k: int,
+    mmr_lambda: float = MMR_LAMBDA
+) -> np.ndarray:
+    """
+    Returns the row indices of candidate_vectors picked by maximal marginal relevance, in pick order.
+    Similarities are cosine and computed as matrix products over all candidates at once, so each
+    greedy step is a handful of vector operations rather than a Python loop over pairs. Only the
+    rows for selected candidates are ever needed, so the full pairwise matrix is never built.
+    """
+    num_candidates = candidate_vectors.shape[0]
+    top_k = min(top_k, num_candidates)
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    candidates = normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    query = normalize(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))
+    query_similarity = candidates @ query.ravel()
+
+    selected = np.empty(top_k, dtype=np.int64)
+    is_selected = np.zeros(num_candidates, dtype=bool)
+    selected[0] = np.argmax(query_similarity)
+    is_selected[selected[0]] = True
+    # Highest similarity of each candidate to anything selected so far
+    max_selected_similarity = candidates @ candidates[selected[0]]
+
+    for step in range(1, top_k):
+        scores = mmr_lambda * query_similarity - (1 - mmr_lambda) * max_selected_similarity
+        scores[is_selected] = -np.inf
+        selected[step] = np.argmax(scores)
+        is_selected[selected[step]] = True
+        np.maximum(max_selected_similarity, candidates @ candidates[selected[step]], out=max_selected_similarity)
+    return selected
+
 def retrieve_relevant_chunks(
     query: str,
     index: faiss.Index,
     all_chunks: List[str],
     embedding_model_name: str,
-    top_k: int = 3
-) -> List[str]:
+    top_k: int = 3,
+    max_distance: Optional[float] = None,
+    fetch_k: int = MMR_FETCH_K,
+    mmr_lambda: float = MMR_LAMBDA
+) -> Optional[List[Tuple[str, float]]]:
+    """
+    Returns up to top_k (chunk, distance) pairs. Lower distances are more similar.
+    Chunks farther than max_distance are dropped. When fetch_k > top_k, fetch_k candidates are
+    retrieved and re-ranked with maximal marginal relevance so the result is not a set of near-duplicates.
+    Returns None if the query could not be embedded or searched, so callers can tell a failure
+    apart from a successful search where every candidate was beyond max_distance.
+    """
     
     if not query or not index or not all_chunks:
         return []
 
-    embedding_client = get_embedding_model(embedding_model_name)
     try:
         # Generate embedding for the query
-        query_embedding_response = embedding_client.create(
-            input=[query],
-            model=embedding_model_name
-        )
-        query_embedding = np.array(query_embedding_response.data[0].embedding).astype('float32').reshape(1, -1)
+        query_embedding = embed_query(query, embedding_model_name)
+
+        # Perform similarity search, over-fetching candidates for re-ranking
+        num_candidates = min(max(top_k, fetch_k), index.ntotal)
+        distances, indices = index.search(query_embedding, num_candidates)
 
-        # Perform similarity search
-        distances, indices = index.search(query_embedding, top_k)
+        candidates = [
+            (int(i), float(distance))
+            for i, distance in zip(indices[0], distances[0])
+            if 0 <= i < len(all_chunks) and (max_distance is None or distance <= max_distance)
+        ]
 
-        relevant_chunks = [all_chunks[i] for i in indices[0] if i < len(all_chunks)]
-        print(f"Retrieved {len(relevant_chunks)} relevant chunks.")
-        return relevant_chunks
+        if len(candidates) > top_k:
+            try:
+                candidate_ids = np.array([i for i, _ in candidates], dtype=np.int64)
+                candidate_vectors = index.reconstruct_batch(candidate_ids)
+                order = mmr_select(query_embedding, candidate_vectors, top_k, mmr_lambda)
+                candidates = [candidates[j] for j in order]
+            except Exception as e:
+                # Some index types can't reconstruct vectors; fall back to plain nearest neighbours
+                print(f"MMR re-ranking unavailable, using nearest neighbours: {e}")
+                candidates = candidates[:top_k]
+
+        scored_chunks = [(all_chunks[i], distance) for i, distance in candidates]
+        print(f"Retrieved {len(scored_chunks)} relevant chunks (distances: {[round(d, 3) for _, d in scored_chunks]}).")
+        return scored_chunks
 
     except Exception as e:
         print(f"Error retrieving relevant chunks: {e}")
-        return []
+        return None
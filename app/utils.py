@@ -7,6 +7,7 @@ from typing import List, Dict
 import io
 import streamlit as st
 import httpx 
+from app.config import OPENAI_API_KEY
 
 # --- Explicitly create an httpx client ignoring environment variables ---
 # This prevents httpx from automatically picking up HTTP_PROXY/HTTPS_PROXY
@@ -24,7 +25,7 @@ except Exception as e:
 # Pass http_client=None if default_http_client could not be initialized
 client = None
 try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=default_http_client)
+    client = OpenAI(api_key=OPENAI_API_KEY, http_client=default_http_client)
 except APIError as e:
     print(f"CRITICAL ERROR: Failed to initialize OpenAI client due to API error: {e}. Please check your API key and network connection.")
     # In a real application, you might want to log this more robustly or exit.
@@ -3,7 +3,8 @@ import os
 # from dotenv import load_dotenv
 # load_dotenv()
 
-from app.retriever import create_and_store_embeddings
+from app.retriever import get_active_index_paths, get_active_index_version, get_index_embedding_model
+from app.rebuild_worker import get_rebuild_manager, QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED
 from app.utils import load_chunks
 from app.main import process_query
 from app.config import (
@@ -16,9 +17,7 @@ from app.config import (
     DEFAULT_EMBEDDING_MODEL,
     DEFAULT_TEXT_GENERATION_MODEL,
     DEFAULT_IMAGE_GENERATION_MODEL,
-    DATA_DIR,
-    FAISS_INDEX_PATH, # We will use this path in session state
-    TEXT_CHUNKS_PATH
+    DATA_DIR
 )
 
 # --- Page Configuration ---
@@ -47,6 +46,14 @@ if "all_chunks" not in st.session_state:
     st.session_state.all_chunks = []
 if "embeddings_built" not in st.session_state:
     st.session_state.embeddings_built = False
+# Version of the knowledge base this session is serving (None for the legacy unversioned files)
+if "kb_version" not in st.session_state:
+    st.session_state.kb_version = None
+if "rebuild_job_id" not in st.session_state:
+    st.session_state.rebuild_job_id = None
+# True until the full script has rerun once after this session's rebuild job finished
+if "rebuild_job_pending" not in st.session_state:
+    st.session_state.rebuild_job_pending = False
 
 # --- Sidebar for Configuration ---
 st.sidebar.header("⚙️ Settings")
@@ -111,43 +118,71 @@ uploaded_files = st.sidebar.file_uploader(
     help="Upload your story PDFs here. These will be used to build the knowledge base, prioritizing them over files in 'data/stories/'."
 )
 
-# Button to rebuild embeddings
-if st.sidebar.button("Rebuild Story Knowledge Base"):
-    # Clear existing index path and chunks in session state before rebuilding
-    st.session_state.faiss_index_path = None
-    st.session_state.all_chunks = []
-    st.session_state.embeddings_built = False
+rebuild_manager = get_rebuild_manager()
 
-    with st.spinner("Building knowledge base... This might take a moment!"):
-        # create_and_store_embeddings will save the index and chunks to disk
-        faiss_index_obj, all_chunks_list = create_and_store_embeddings(
-            st.session_state.selected_embedding_model,
-            uploaded_files=uploaded_files # Pass uploaded files
-        )
-        
-        if faiss_index_obj is not None and all_chunks_list:
-            st.session_state.faiss_index_path = FAISS_INDEX_PATH # Store the path
-            st.session_state.all_chunks = all_chunks_list
-            st.session_state.embeddings_built = True
-            st.sidebar.success("Knowledge Base Built Successfully!")
-        else:
-            st.sidebar.error("Failed to build Knowledge Base. Check console for errors. Ensure PDFs are valid.")
-
-# Load existing embeddings on app start if not already loaded
-# We only check if the files exist, the actual loading happens in process_query
-if not st.session_state.embeddings_built:
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(TEXT_CHUNKS_PATH):
+# Button to queue a rebuild. The build runs on a background worker, so this session keeps
+# serving the current knowledge base until the new version has been published.
+if st.sidebar.button("Rebuild Story Knowledge Base"):
+    job = rebuild_manager.submit(
+        st.session_state.selected_embedding_model,
+        uploaded_files=uploaded_files # Pass uploaded files
+    )
+    st.session_state.rebuild_job_id = job.id
+    st.session_state.rebuild_job_pending = True
+
+# Load the published knowledge base on app start, or switch to a newer version once one is published
+# We only check if the files exist, the actual FAISS loading happens in process_query
+active_version, active_index_path, active_chunks_path = get_active_index_paths()
+if not st.session_state.embeddings_built or active_version != st.session_state.kb_version:
+    if os.path.exists(active_index_path) and os.path.exists(active_chunks_path):
         # We don't load the FAISS object here, just confirm files exist and store path
-        st.session_state.faiss_index_path = FAISS_INDEX_PATH
-        st.session_state.all_chunks = load_chunks(TEXT_CHUNKS_PATH) # Load chunks once
-        if st.session_state.all_chunks: 
+        active_chunks = load_chunks(active_chunks_path) # Load chunks once per version
+        if active_chunks:
+            st.session_state.faiss_index_path = active_index_path
+            st.session_state.all_chunks = active_chunks
+            st.session_state.kb_version = active_version
             st.session_state.embeddings_built = True
-            st.sidebar.success("Loaded existing Knowledge Base (from disk).")
-        else:
+            st.sidebar.success("Loaded Knowledge Base (from disk).")
+        elif not st.session_state.embeddings_built:
             st.session_state.faiss_index_path = None # Reset if chunks failed to load
             st.sidebar.warning("Could not load existing Knowledge Base chunks. Please rebuild it.")
-    else:
+    elif not st.session_state.embeddings_built:
         st.sidebar.info("No existing Knowledge Base found. Upload PDFs or place them in 'data/stories/' and click 'Rebuild Story Knowledge Base' to get started.")
+# Queries always use the embedding model the knowledge base was built with, so flag a different selection
+if st.session_state.faiss_index_path:
+    index_embedding_model = get_index_embedding_model(st.session_state.faiss_index_path)
+    if index_embedding_model and index_embedding_model != st.session_state.selected_embedding_model:
+        st.sidebar.info(f"The Knowledge Base was built with {index_embedding_model}, so queries use that model. Rebuild it to switch to {st.session_state.selected_embedding_model}.")
+
+# Remember which version this run saw, so the status fragment can tell when a newer one is published
+st.session_state.checked_kb_version = active_version
+
+# Rebuild status and active-version polling. The fragment reruns on its own every couple of
+# seconds without rerunning the whole script, and triggers a full rerun when this session's
+# rebuild finishes or another version is published so the check above picks up the new index.
+@st.experimental_fragment(run_every=2)
+def rebuild_status():
+    rebuild_job = rebuild_manager.get_job(st.session_state.rebuild_job_id) if st.session_state.rebuild_job_id else None
+    if rebuild_job is not None:
+        if rebuild_job.is_finished and st.session_state.rebuild_job_pending:
+            st.session_state.rebuild_job_pending = False
+            st.rerun()
+        if rebuild_job.status in (QUEUED, RUNNING):
+            st.progress(rebuild_job.progress, text=rebuild_job.message)
+            if not rebuild_job.cancel_event.is_set() and st.button("Cancel Rebuild"):
+                rebuild_manager.cancel(rebuild_job.id)
+        elif rebuild_job.status == SUCCEEDED:
+            st.success(rebuild_job.message)
+        elif rebuild_job.status == CANCELLED:
+            st.warning(rebuild_job.message)
+        elif rebuild_job.status == FAILED:
+            st.error(rebuild_job.message)
+
+    if get_active_index_version() != st.session_state.checked_kb_version:
+        st.rerun()
+
+with st.sidebar:
+    rebuild_status()
 
 # --- Chat Interface ---
 # Display chat messages from history on app rerun